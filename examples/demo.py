@@ -21,11 +21,12 @@ def demo():
         def setup_state(self):
             self.state.seed = 0
             self.state.img = None
-            self.state._backup_img = np.ascontiguousarray(cv2.imread('index.png')[..., ::-1])
+            self.state._backup_img = torch.from_numpy(cv2.cvtColor(cv2.imread('index.png'), cv2.COLOR_BGR2RGB)).pin_memory()
+            self.state.img_gpu = self.state._backup_img.to('cuda:0', non_blocking=True) # static image, upload once
         
         def compute(self):
-            self.state.img = torch.from_numpy(self.state._backup_img).to('cuda:0')
-            return self.state.img
+            self.state.img = self.state.img_gpu
+            return {self.output_key: self.state.img}
 
         def draw_toolbar(self):
             self.state.seed = imgui.slider_int('Seed', self.state.seed, 0, 1000)[1]
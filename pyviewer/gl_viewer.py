@@ -6,10 +6,14 @@ import numpy as np
 import multiprocessing as mp
 from pathlib import Path
 from urllib.request import urlretrieve
-from threading import get_ident
+from threading import get_ident, Lock, Condition
 import os
+import time
+import ctypes
+import weakref
 from sys import platform
 from contextlib import contextmanager, nullcontext
+from collections import OrderedDict
 
 import imgui.core
 # import imgui.plot as implot
@@ -36,107 +40,324 @@ try:
 except Exception:
     print('PyCUDA with GL support not available, images will be uploaded from RAM.')
 
+# Direct State Access (GL 4.5) modifies textures without touching bind points.
+# Queried lazily since it requires a current context. MacOS is stuck at GL 4.1.
+_has_dsa = None
+def has_dsa():
+    global _has_dsa
+    if _has_dsa is None:
+        _has_dsa = 'darwin' not in platform and _gl_version() >= (4, 5) and bool(gl.glCreateTextures)
+    return _has_dsa
+
+# Persistently mapped buffers (GL 4.4) stay mapped for their whole lifetime.
+_has_persistent_map = None
+def has_persistent_map():
+    global _has_persistent_map
+    if _has_persistent_map is None:
+        _has_persistent_map = 'darwin' not in platform and _gl_version() >= (4, 4) and bool(gl.glBufferStorage)
+    return _has_persistent_map
+
+def _gl_version():
+    version = (gl.glGetIntegerv(gl.GL_MAJOR_VERSION), gl.glGetIntegerv(gl.GL_MINOR_VERSION))
+    return tuple(int(v) for v in version)
+
+# Float to uint8 conversion into preallocated buffers, input left untouched
+# scale: 255 for data in [0,1], 1 for data in [0,255]
+def _fp_to_u8(img, scale, out, scratch):
+    torch.mul(img, scale, out=scratch).clamp_(0, 255)
+    return out.copy_(scratch)
+
+# Texture layouts: (internal format, pixel format, swizzle RGBA)
+# Swizzling lets the sampler replicate grayscale and synthesize alpha,
+# no need to expand the data itself before upload.
+_SWIZZLE_KEYS = (gl.GL_TEXTURE_SWIZZLE_R, gl.GL_TEXTURE_SWIZZLE_G, gl.GL_TEXTURE_SWIZZLE_B, gl.GL_TEXTURE_SWIZZLE_A)
+_formats = {
+    'gray': (gl.GL_R8, gl.GL_RED, (gl.GL_RED, gl.GL_RED, gl.GL_RED, gl.GL_ONE)),
+    'rgb': (gl.GL_RGB8, gl.GL_RGB, (gl.GL_RED, gl.GL_GREEN, gl.GL_BLUE, gl.GL_ONE)),
+    'rgbx': (gl.GL_RGBA8, gl.GL_RGBA, (gl.GL_RED, gl.GL_GREEN, gl.GL_BLUE, gl.GL_ONE)), # alpha ignored
+    'rgba': (gl.GL_RGBA8, gl.GL_RGBA, (gl.GL_RED, gl.GL_GREEN, gl.GL_BLUE, gl.GL_ALPHA)),
+}
+
+class _buffer_pool:
+    '''
+    Pool of uint8 CUDA staging buffers shared by all textures of a viewer.
+    Buffers are handed out by shape, idle ones are evicted LRU beyond max_bytes.
+    Used with GL context lock held or from UI thread.
+    '''
+    def __init__(self, max_bytes=256*2**20):
+        self.max_bytes = max_bytes
+        self._free = OrderedDict() # (shape, device) => [tensor]
+        self._free_bytes = 0
+
+    def acquire(self, shape, device):
+        key = (tuple(shape), str(device))
+        bufs = self._free.get(key)
+        if not bufs:
+            return torch.empty(shape, dtype=torch.uint8, device=device)
+        buf = bufs.pop()
+        if not bufs:
+            del self._free[key]
+        self._free_bytes -= buf.numel()
+        return buf
+
+    def release(self, buf):
+        key = (tuple(buf.shape), str(buf.device))
+        self._free.setdefault(key, []).append(buf)
+        self._free.move_to_end(key)
+        self._free_bytes += buf.numel()
+        while self._free_bytes > self.max_bytes:
+            _, bufs = self._free.popitem(last=False)
+            self._free_bytes -= sum(b.numel() for b in bufs)
+
 class _texture:
     '''
     This class maps torch tensors to gl textures without a CPU roundtrip.
     '''
-    def __init__(self, min_mag_filter=gl.GL_LINEAR):
-        self.tex = gl.glGenTextures(1)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex) # need to bind to modify
-        # sets repeat and filtering parameters; change the second value of any tuple to change the value
-        for params in ((gl.GL_TEXTURE_WRAP_S, gl.GL_REPEAT), (gl.GL_TEXTURE_WRAP_T, gl.GL_REPEAT), (gl.GL_TEXTURE_MIN_FILTER, min_mag_filter), (gl.GL_TEXTURE_MAG_FILTER, min_mag_filter)):
-            gl.glTexParameteri(gl.GL_TEXTURE_2D, *params)
+    def __init__(self, min_mag_filter=gl.GL_LINEAR, pool=None):
+        self.dsa = has_dsa()
+        self._pool = pool or _buffer_pool()
+        # sets repeat and filtering parameters; change the second value of any pair to change the value
+        self.params = {gl.GL_TEXTURE_WRAP_S: gl.GL_REPEAT, gl.GL_TEXTURE_WRAP_T: gl.GL_REPEAT, gl.GL_TEXTURE_MIN_FILTER: min_mag_filter, gl.GL_TEXTURE_MAG_FILTER: min_mag_filter}
+        self.tex = self._create_texture()
         self.mapper = None
         self.shape = [0,0] # texture
+        self._layout = None # key into _formats
         self._cuda_buffer = None
+        self._pinned_host = None # page-locked staging for RAM fallback
+        self._u8_host = None # conversion target for non-uint8 numpy input
+        self._fp_scratch = None # float to uint8 conversion buffers for torch input
+        self._u8_buf = None
+        self._persistent = has_persistent_map()
+        self._pbos = gl.glGenBuffers(3 if self._persistent else 2) # pixel unpack buffers, used in turns
+        self._pbo_idx = 0
+        self._pbo_ptrs = [None] * len(self._pbos) # persistent mappings
+        self._pbo_fences = [None] * len(self._pbos) # signaled once GPU is done reading
+        self._pbo_size = 0
+        self._last_src = None # (weakref, version counter, value_range) of last uploaded tensor
+        self._stream = None # CUDA stream for texture copies, created on first use
+        self._inflight = None # source of pending async copy, kept alive until done
 
     # be sure to del textures if you create a forget them often (python doesn't necessarily call del on garbage collect)
     def __del__(self):
         gl.glDeleteTextures(1, [self.tex])
+        for fence in self._pbo_fences:
+            if fence is not None:
+                gl.glDeleteSync(fence)
+        gl.glDeleteBuffers(len(self._pbos), self._pbos)
+        if self.mapper is not None:
+            self.mapper.unregister()
+        if self._cuda_buffer is not None:
+            self._pool.release(self._cuda_buffer)
+
+    def _create_texture(self):
+        if self.dsa:
+            tex = np.zeros(1, dtype=np.uint32)
+            gl.glCreateTextures(gl.GL_TEXTURE_2D, 1, tex)
+            tex = int(tex[0])
+            for key, val in self.params.items():
+                gl.glTextureParameteri(tex, key, val)
+        else:
+            tex = gl.glGenTextures(1)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, tex) # need to bind to modify
+            for key, val in self.params.items():
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, key, val)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        return tex
+
+    def _needs_alloc(self, shape, layout):
+        return shape[0] != self.shape[0] or shape[1] != self.shape[1] or layout != self._layout
+
+    # (Re)allocate texture storage, invalidates CUDA registration
+    def _allocate(self, shape, layout):
         if self.mapper is not None:
             self.mapper.unregister()
+            self.mapper = None
+        self.shape = shape
+        self._layout = layout
+        internal_format, fmt, swizzle = _formats[layout]
+        self.params.update(zip(_SWIZZLE_KEYS, swizzle))
+        if self.dsa:
+            # Storage is immutable, resizing requires a new texture
+            gl.glDeleteTextures(1, [self.tex])
+            self.tex = self._create_texture()
+            gl.glTextureStorage2D(self.tex, 1, internal_format, shape[1], shape[0])
+        else:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex)
+            for key, val in zip(_SWIZZLE_KEYS, swizzle):
+                gl.glTexParameteri(gl.GL_TEXTURE_2D, key, val)
+            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, internal_format, shape[1], shape[0], 0, fmt, gl.GL_UNSIGNED_BYTE, None)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+
+    # Overwrite full texture, data=None reads from bound PBO
+    def _write(self, data):
+        H, W = self.shape[0:2]
+        fmt = _formats[self._layout][1]
+        if self.dsa:
+            gl.glTextureSubImage2D(self.tex, 0, 0, 0, W, H, fmt, gl.GL_UNSIGNED_BYTE, data)
+        else:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex)
+            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, W, H, fmt, gl.GL_UNSIGNED_BYTE, data)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
 
     def set_interp(self, key, val):
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex)
-        gl.glTexParameteri(gl.GL_TEXTURE_2D, key, val)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        self.params[key] = val
+        if self.dsa:
+            gl.glTextureParameteri(self.tex, key, val)
+        else:
+            gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex)
+            gl.glTexParameteri(gl.GL_TEXTURE_2D, key, val)
+            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
 
-    def upload_np(self, image):
-        image = normalize_image_data(image, 'uint8')
+    # True if tensor is the one last uploaded, not modified in-place since
+    # Inference tensors don't track versions => always considered dirty
+    # Writes through .data, DLPack or custom kernels don't bump the version => opt-in only
+    def is_current(self, img, value_range=None):
+        if self._last_src is None or img.is_inference():
+            return False
+        ref, version, prev_range = self._last_src
+        return ref() is img and version == img._version and prev_range == value_range
 
+    def upload_np(self, image):
+        self._last_src = None
         # support for shapes (h,w), (h,w,1), (h,w,3) and (h,w,4)
         if len(image.shape) == 2:
             image = np.expand_dims(image, -1)
-        if image.shape[2] == 1:
-            image = np.repeat(image, 3, axis=-1) #image.repeat(1,1,3)
-        # if image.shape[2] == 3:
-        #     image = np.concatenate([image, np.ones_like(image[:,:,0:1])*255], axis=-1)
 
+        # Reuse conversion buffer across frames, uint8 data used as-is
+        out = None
+        if image.dtype != np.uint8:
+            out_shape = (*image.shape[:2], min(image.shape[2], 3))
+            if self._u8_host is None or self._u8_host.shape != out_shape:
+                self._u8_host = np.empty(out_shape, dtype=np.uint8)
+            out = self._u8_host
+        image = normalize_image_data(image, 'uint8', out=out)
         shape = image.shape
+        layout = 'gray' if shape[2] == 1 else 'rgb'
         
-        gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex)
         gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
-        if shape[0] != self.shape[0] or shape[1] != self.shape[1]:
-            # Reallocate
-            self.shape = shape
-            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGB, shape[1], shape[0], 0, gl.GL_RGB, gl.GL_UNSIGNED_BYTE, image)
-        else:
-            # Overwrite
-            gl.glTexSubImage2D(gl.GL_TEXTURE_2D, 0, 0, 0, shape[1], shape[0], gl.GL_RGB, gl.GL_UNSIGNED_BYTE, image)
-        gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        if self._needs_alloc(shape, layout):
+            self._allocate(shape, layout)
+
+        if self._persistent:
+            self._upload_persistent(image)
+            return
+
+        # Stage through PBO: driver performs the DMA asynchronously,
+        # alternating buffers avoids waiting on the previous transfer
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, int(self._pbos[self._pbo_idx]))
+        gl.glBufferData(gl.GL_PIXEL_UNPACK_BUFFER, image.nbytes, None, gl.GL_STREAM_DRAW) # orphan old storage
+        ptr = gl.glMapBufferRange(gl.GL_PIXEL_UNPACK_BUFFER, 0, image.nbytes,
+            gl.GL_MAP_WRITE_BIT | gl.GL_MAP_INVALIDATE_BUFFER_BIT | gl.GL_MAP_UNSYNCHRONIZED_BIT)
+        ctypes.memmove(ptr, image.ctypes.data, image.nbytes)
+        gl.glUnmapBuffer(gl.GL_PIXEL_UNPACK_BUFFER)
+        self._write(None)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        self._pbo_idx ^= 1
+
+    # (Re)create PBO ring with immutable storage, mapped until deleted
+    def _alloc_pbos(self, nbytes):
+        for fence in self._pbo_fences:
+            if fence is not None:
+                gl.glDeleteSync(fence)
+        gl.glDeleteBuffers(len(self._pbos), self._pbos) # also unmaps
+        self._pbos = gl.glGenBuffers(len(self._pbos))
+        flags = gl.GL_MAP_WRITE_BIT | gl.GL_MAP_PERSISTENT_BIT | gl.GL_MAP_COHERENT_BIT
+        for i, pbo in enumerate(self._pbos):
+            gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, int(pbo))
+            gl.glBufferStorage(gl.GL_PIXEL_UNPACK_BUFFER, nbytes, None, flags)
+            self._pbo_ptrs[i] = gl.glMapBufferRange(gl.GL_PIXEL_UNPACK_BUFFER, 0, nbytes, flags)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        self._pbo_fences = [None] * len(self._pbos)
+        self._pbo_size = nbytes
+
+    # Plain memcpy into a mapped slot, no map/unmap per frame.
+    # Fence per slot guards against overwriting data the GPU hasn't consumed.
+    def _upload_persistent(self, image):
+        if image.nbytes > self._pbo_size:
+            self._alloc_pbos(image.nbytes)
+        i = self._pbo_idx
+        fence = self._pbo_fences[i]
+        if fence is not None:
+            while gl.glClientWaitSync(fence, gl.GL_SYNC_FLUSH_COMMANDS_BIT, 1_000_000) == gl.GL_TIMEOUT_EXPIRED:
+                pass
+            gl.glDeleteSync(fence)
+        ctypes.memmove(self._pbo_ptrs[i], image.ctypes.data, image.nbytes)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, int(self._pbos[i]))
+        self._write(None)
+        gl.glBindBuffer(gl.GL_PIXEL_UNPACK_BUFFER, 0)
+        self._pbo_fences[i] = gl.glFenceSync(gl.GL_SYNC_GPU_COMMANDS_COMPLETE, 0)
+        self._pbo_idx = (i + 1) % len(self._pbos)
 
     @torch.no_grad()
-    def upload_torch(self, img):
-        assert img.device.type == "cuda", "Please provide a CUDA tensor"
-        assert img.ndim == 3, "Please provide a HWC tensor"
-        assert img.shape[2] < min(img.shape[0], img.shape[1]), "Please provide a HWC tensor"
+    # Arguments validated by caller (viewer._torch_item)
+    def upload_torch(self, img, value_range=None):
+        src = img
+        self._wait_copy() # previous async copy may read from buffers reused below
 
         if img.dtype.is_floating_point:
-            if img.max() <= 1.0:
-                img *= 255
-            img = (img).byte()
-
-        if img.shape[2] == 1:
-            img = img.repeat(1,1,3)
-        if img.shape[2] == 3:
-            if (self._cuda_buffer is None) or (img.shape[0] != self._cuda_buffer.shape[0] or img.shape[1] != self._cuda_buffer.shape[1]):
-                self._cuda_buffer = torch.ones((img.shape[0], img.shape[1], 4), dtype=torch.uint8, device=img.device) * 255
-                self._cuda_buffer.requires_grad = False
-            self._cuda_buffer[..., :-1] = img
-        elif img.shape[2] == 4:
-            if (self._cuda_buffer is not None) and (img.shape == self._cuda_buffer.shape):
-                self._cuda_buffer[:] = img
-            else:
-                self._cuda_buffer = img
-
-        # img = img.contiguous()
-        if has_pycuda:
-            self.upload_ptr(self._cuda_buffer.data_ptr(), self._cuda_buffer.shape)
+            # Detect range if not provided: costs an extra full-tensor reduction
+            is_unit = (value_range == '0-1') if value_range else (img.max() <= 1.0)
+            scratch = self._fp_scratch
+            if scratch is None or scratch.shape != img.shape or scratch.dtype != img.dtype or scratch.device != img.device:
+                self._fp_scratch = torch.empty_like(img, memory_format=torch.contiguous_format)
+                self._u8_buf = torch.empty(img.shape, dtype=torch.uint8, device=img.device)
+            img = _fp_to_u8(img, 255 if is_unit else 1, self._u8_buf, self._fp_scratch)
+
+        # RAM fallback: glTexImage2D takes RGB directly, no padding needed.
+        # Copy through persistent pinned memory to avoid pageable allocs.
+        if not has_pycuda:
+            if self._pinned_host is None or self._pinned_host.shape != img.shape:
+                self._pinned_host = torch.empty(img.shape, dtype=torch.uint8, pin_memory=True)
+            self._pinned_host.copy_(img, non_blocking=True)
+            cuda_synchronize()
+            self.upload_np(self._pinned_host.numpy())
         else:
-            self.upload_np(self._cuda_buffer.detach().cpu().numpy())
-        # if has_pycuda:
-        #     self.upload_ptr(img.data_ptr(), img.shape)
-        # else:
-        #     self.upload_np(img.detach().cpu().numpy())
+            # CUDA-GL interop cannot register 3-channel textures => pad to RGBA.
+            # Buffer only reallocated on shape change, alpha ignored via swizzle.
+            opaque = False
+            if img.shape[2] == 3:
+                if self._cuda_buffer is None or self._cuda_buffer.shape[:2] != img.shape[:2]:
+                    if self._cuda_buffer is not None:
+                        self._pool.release(self._cuda_buffer)
+                    self._cuda_buffer = self._pool.acquire((img.shape[0], img.shape[1], 4), img.device)
+                self._cuda_buffer[..., :3] = img
+                img = self._cuda_buffer
+                opaque = True
+
+            img = img.contiguous()
+            torch.cuda.current_stream(img.device).synchronize() # conversion done before copy on own stream
+
+            # Async only from texture-owned or private buffers: caller's own tensor
+            # could be modified on torch's stream while the copy still reads it
+            owned = img is not src
+            self.upload_ptr(img.data_ptr(), img.shape, opaque, sync=not owned)
+            if owned:
+                self._inflight = img
+
+        if not src.is_inference():
+            self._last_src = (weakref.ref(src), src._version, value_range)
+
+    def _wait_copy(self):
+        if self._stream is not None:
+            self._stream.synchronize()
+        self._inflight = None
 
     # Copy from cuda pointer
-    def upload_ptr(self, ptr, shape):
-        assert has_pycuda, 'PyCUDA-GL not available, cannot upload using raw pointer'
-        # assert shape[-1] == 3, 'Data format not RGB'
-        
-        # reallocate if shape changed or data type changed from np to torch
+    # Supports 1 and 4 channels, opaque: ignore alpha channel
+    # sync=False: return before copy is done, caller keeps source memory valid
+    # Arguments validated by caller (viewer.upload_image_TF_ptr)
+    def upload_ptr(self, ptr, shape, opaque=False, sync=True):
+        self._last_src = None
+        self._wait_copy()
+        if self._stream is None:
+            self._stream = pycuda.driver.Stream()
         
-        if shape[0] != self.shape[0] or shape[1] != self.shape[1] or self.mapper is None:
-            self.shape = shape
-            if self.mapper is not None:
-                self.mapper.unregister()
-
-            gl.glBindTexture(gl.GL_TEXTURE_2D, self.tex)
-            gl.glPixelStorei(gl.GL_UNPACK_ALIGNMENT, 1)
-            gl.glTexImage2D(gl.GL_TEXTURE_2D, 0, gl.GL_RGBA , shape[1], shape[0], 0, gl.GL_RGBA, gl.GL_UNSIGNED_BYTE, None)
-            gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        # reallocate if shape or layout changed, or data type changed from np to torch
+        layout = 'gray' if shape[2] == 1 else ('rgbx' if opaque else 'rgba')
+        if self._needs_alloc(shape, layout) or self.mapper is None:
+            self._allocate(shape, layout)
             self.mapper = cuda_gl.RegisteredImage(int(self.tex), gl.GL_TEXTURE_2D, pycuda.gl.graphics_map_flags.WRITE_DISCARD)
-        tex_data = self.mapper.map()
+        tex_data = self.mapper.map(self._stream)
         tex_arr = tex_data.array(0, 0)
         ptr_int = int(ptr)
         assert ptr_int == ptr, 'Device pointer overflow'
@@ -149,12 +370,12 @@ class _texture:
         # cpy.dst_pitch = int(cpy.dst_pitch / 3 * 4)
         # cpy.src_pitch = int(cpy.src_pitch / 3 * 4)
         cpy.height = shape[0]
-        cpy(aligned=False)
+        cpy(self._stream) # async
 
-        # cleanup
-        tex_data.unmap()
-        cuda_synchronize()
-        # gl.glBindTexture(gl.GL_TEXTURE_2D, 0)
+        # Unmap is stream-ordered: GL commands issued afterwards see the copied data
+        tex_data.unmap(self._stream)
+        if sync:
+            self._wait_copy()
 
 
 class _editable:
@@ -166,11 +387,41 @@ class _editable:
         self.run_exception = ''
         self.ui_exception = ''
         self.ui_code_visible = False
-    def try_execute(self, string, **kwargs):
+        self.ui_fn = None # registered callable, replaces ui code until new code is applied
+
+    # Code is compiled once on assignment, not on every execution
+    @property
+    def ui_code(self):
+        return self._ui_code
+
+    @ui_code.setter
+    def ui_code(self, code):
+        if code != getattr(self, '_ui_code', None):
+            self._ui_code = code
+            self._ui_code_obj = self.try_compile(code)
+
+    @property
+    def run_code(self):
+        return self._run_code
+
+    @run_code.setter
+    def run_code(self, code):
+        if code != getattr(self, '_run_code', None):
+            self._run_code = code
+            self._run_code_obj = self.try_compile(code)
+
+    # Returns code object, or error message string
+    def try_compile(self, string):
+        try:
+            return compile(string, f'<{self.name}>', 'exec')
+        except Exception as e:
+            return 'Exception: ' + str(e)
+
+    def try_execute(self, code, **kwargs):
+        if isinstance(code, str):
+            return code # compilation failed
         try:
-            for key, value in kwargs.items():
-                locals()[key] = value
-            exec(string)
+            exec(code, globals(), kwargs)
         except Exception as e: # while generally a bad idea, here we truly want to skip any potential error to not disrupt the worker threads
             return 'Exception: ' + str(e)
         return ''
@@ -186,15 +437,24 @@ class _editable:
             self.tentative_ui_code = imgui.input_text_multiline('ui code', self.tentative_ui_code, 2048)[1]
             if imgui.button('Apply UI code'):
                 self.ui_code = self.tentative_ui_code
+                self.ui_fn = None
             if len(self.ui_exception)>0:
                 imgui.text(self.ui_exception)
                 
         imgui.end()
 
-        self.ui_exception = self.try_execute(self.ui_code, v=v)
+        # Plain call, no exec, unless the user is editing the code
+        if self.ui_fn is not None and not self.ui_code_visible:
+            try:
+                self.ui_fn(v)
+                self.ui_exception = ''
+            except Exception as e: # same as for ui code: don't let user errors stop the UI loop
+                self.ui_exception = 'Exception: ' + str(e)
+        else:
+            self.ui_exception = self.try_execute(self._ui_code_obj, v=v)
 
     def run(self, **kwargs):
-        self.run_exception = self.try_execute(self.run_code, **kwargs)
+        self.run_exception = self.try_execute(self._run_code_obj, **kwargs)
 
 
 class viewer:
@@ -206,6 +466,7 @@ class viewer:
         self.tex_interp_mode = gl.GL_LINEAR
         self.default_font_size = 36
         self._cuda_context = None
+        self._staging_pool = _buffer_pool() # shared by all textures
         
         fname = inifile or "".join(c for c in title.lower() if c.isalnum())
         self._inifile = Path(fname).with_suffix('.ini')
@@ -215,19 +476,21 @@ class viewer:
         
         try:
             with open(self._inifile, 'r') as file:
-                self._width, self._height = [int(i) for i in file.readline().split()]
-                self.window_pos = [int(i) for i in file.readline().split()]
-                start_maximized = int(file.readline().rstrip())
-                self.ui_scale = float(file.readline().rstrip())
-                self.fullscreen = bool(int(file.readline().rstrip()))
-                key = file.readline().rstrip()
-                while key is not None and len(key)>0:
-                    code = [None, None]
-                    for i in range(2):
-                        lines = int(file.readline().rstrip())
-                        code[i] = '\n'.join((file.readline().rstrip() for _ in range(lines)))
-                    self._editables[key] = _editable(key, code[0], code[1])
-                    key = file.readline().rstrip()
+                ini_lines = iter(file.read().split('\n')) # single read
+            readline = lambda: next(ini_lines, '').rstrip()
+            self._width, self._height = [int(i) for i in readline().split()]
+            self.window_pos = [int(i) for i in readline().split()]
+            start_maximized = int(readline())
+            self.ui_scale = float(readline())
+            self.fullscreen = bool(int(readline()))
+            key = readline()
+            while key is not None and len(key)>0:
+                code = [None, None]
+                for i in range(2):
+                    lines = int(readline())
+                    code[i] = '\n'.join((readline() for _ in range(lines)))
+                self._editables[key] = _editable(key, code[0], code[1])
+                key = readline()
         except Exception as e:
             self._width, self._height = 1280, 720
             self.window_pos = (50, 50)
@@ -295,9 +558,38 @@ class viewer:
                 glyph_ranges=handle.get_glyph_ranges_chinese_full()) for size in font_sizes
         }
 
+        # Nearest available font size for integer targets [0, 127]
+        self._font_size_lut = [min(font_sizes, key=lambda k: (abs(k - t), k)) for t in range(128)]
+
         self._context_lock = mp.Lock()
         self._context_tid = None # id of thread in critical section
 
+        # While the UI loop runs, its thread keeps the GL context current.
+        # Uploads from other threads are queued and performed by the UI thread.
+        self._ui_tid = None
+        self._pending_uploads = {} # name => (method, args, cuda event), latest wins
+        self._pending_lock = Lock()
+        self._processing = {} # uploads currently performed by UI thread
+        self._uploads_done = Condition(self._pending_lock)
+
+        # Frames are only drawn after input, uploads or resizes (or at keep-alive interval)
+        self._frame_dirty = 1 # number of frames left to draw
+        self._dirty_lock = Lock() # updated from worker threads and UI thread
+        self.idle_redraw_interval = 0.1 # seconds, loopfunc still runs periodically when idle
+
+        # Key state bitmaps, indexed by glfw key code
+        self._pressed_keys = bytearray(512)
+        self._hit_keys = bytearray(512)
+
+        # upload_image() item builders by (type, device type)
+        # mps/cpu would require gl-metal interop or metal UI backend => via numpy
+        self._upload_dispatch = {
+            (torch.Tensor, 'cuda'): self._torch_item if use_cuda else self._tensor_np_item,
+            (torch.Tensor, 'cpu'): self._tensor_np_item,
+            (torch.Tensor, 'mps'): self._tensor_np_item,
+            (np.ndarray, None): self._np_item,
+        }
+
     def get_default_font(self):
         return str(Path(__file__).parent / 'MPLUSRounded1c-Medium.ttf')
     
@@ -323,8 +615,13 @@ class viewer:
         try:
             self._context_lock.acquire()
             self._context_tid = tid
-            glfw.make_context_current(self._window)
-            context_manager = self._context_lock
+            if self._ui_tid is None:
+                glfw.make_context_current(self._window)
+                context_manager = self._context_lock
+            elif self._ui_tid == tid:
+                context_manager = self._context_lock # already current
+            else:
+                context_manager = nullcontext # owned by UI thread
         except glfw.GLFWError as e:
             reason = {65544: 'No monitor found'}.get(e.error_code, 'unknown')
             print(f'{str(e)} (code 0x{e.error_code:x}: "{reason}")')
@@ -335,7 +632,8 @@ class viewer:
             yield context_manager
 
             # Cleanup after caller is done
-            glfw.make_context_current(None)
+            if self._ui_tid is None:
+                glfw.make_context_current(None)
             self._context_tid = None
             self._context_lock.release()
 
@@ -364,14 +662,18 @@ class viewer:
             self._editables[name] = _editable(name)
         self._editables[name].run(**kwargs)
 
+    # Draw UI of editable 'name' with fn(viewer) instead of executing its ui code
+    def register_callable(self, name, fn):
+        if name not in self._editables:
+            self._editables[name] = _editable(name)
+        self._editables[name].ui_fn = fn
+
     def keydown(self, key):
-        return key in self._pressed_keys
+        return bool(self._pressed_keys[key])
 
     def keyhit(self, key):
-        if key in self._hit_keys:
-            self._hit_keys.remove(key)
-            return True
-        return False
+        hit, self._hit_keys[key] = self._hit_keys[key], 0
+        return bool(hit)
 
     def draw_image(self, name, scale=1, width=None, pad_h=0, pad_v=0):
         if name in self._images:
@@ -390,16 +692,25 @@ class viewer:
     def close(self):
         glfw.set_window_should_close(self._window, True)
 
+    # Draw a few frames: imgui needs extra frames to settle hover states etc.
+    def request_redraw(self, frames=3):
+        with self._dirty_lock:
+            self._frame_dirty = max(self._frame_dirty, frames)
+        if self._ui_tid is not None and self._ui_tid != get_ident():
+            glfw.post_empty_event() # wake UI thread from wait_events_timeout
+
     @property
     def font_size(self):
         return self._cur_font_size
 
     @property
     def spacing(self):
-        return round(self._cur_font_size * 0.3) # 0.4
+        return self._spacing
 
     def set_font_size(self, target): # Applied on next frame.
-        self._cur_font_size = min((abs(key - target), key) for key in self._imgui_fonts.keys())[1]
+        lut = self._font_size_lut
+        self._cur_font_size = lut[max(0, min(len(lut) - 1, int(round(target))))]
+        self._spacing = round(self._cur_font_size * 0.3) # 0.4
 
     def toggle_fullscreen(self):
         self.fullscreen = not self.fullscreen
@@ -453,18 +764,13 @@ class viewer:
         
         with self.lock():
             impl = GlfwRenderer(self._window)
+            self._ui_tid = get_ident() # context stays current from here on
         
-        self._pressed_keys = set()
-        self._hit_keys = set()
-
         def on_key(window, key, scan, pressed, mods):
-            if pressed:
-                if key not in self._pressed_keys:
-                    self._hit_keys.add(key)
-                self._pressed_keys.add(key)
-            else:
-                if key in self._pressed_keys:
-                    self._pressed_keys.remove(key) # check seems to be needed over RDP sometimes
+            if 0 <= key < len(self._pressed_keys): # KEY_UNKNOWN is -1
+                if pressed and not self._pressed_keys[key]:
+                    self._hit_keys[key] = 1
+                self._pressed_keys[key] = 1 if pressed else 0
             if key != glfw.KEY_ESCAPE: # imgui erases text with escape (??)
                 impl.keyboard_callback(window, key, scan, pressed, mods)
 
@@ -474,8 +780,31 @@ class viewer:
         if glfw_init_callback is not None:
             glfw_init_callback(self._window)
 
+        # Redraw on any input or window change, chained with existing callbacks
+        def redraw_on(setter):
+            prev = None
+            def callback(*args):
+                self.request_redraw()
+                if prev is not None:
+                    prev(*args)
+            prev = setter(self._window, callback)
+
+        for setter in (glfw.set_key_callback, glfw.set_char_callback, glfw.set_cursor_pos_callback,
+            glfw.set_mouse_button_callback, glfw.set_scroll_callback, glfw.set_window_size_callback,
+            glfw.set_framebuffer_size_callback, glfw.set_window_focus_callback,
+            glfw.set_window_iconify_callback, glfw.set_window_refresh_callback):
+            redraw_on(setter)
+
+        t_last_frame = time.perf_counter()
         while not glfw.window_should_close(self._window):
             glfw.poll_events()
+
+            # Nothing changed or minimized: block until event instead of spinning
+            idle = self._frame_dirty <= 0 or glfw.get_window_attrib(self._window, glfw.ICONIFIED)
+            if idle and time.perf_counter() - t_last_frame < self.idle_redraw_interval:
+                glfw.wait_events_timeout(1/60)
+                continue
+
             impl.process_inputs()
 
             if self.keyhit(glfw.KEY_ESCAPE):
@@ -488,6 +817,7 @@ class viewer:
                 # Breaks on MacOS. Needed?
                 #imgui.get_io().display_size = glfw.get_framebuffer_size(self._window)
                 
+                self._process_uploads()
                 imgui.new_frame()
 
                 # Tero viewer:
@@ -510,28 +840,34 @@ class viewer:
                 # TODO: compute thread has to wait until sync is done
                 # and lock is released if calling upload_image()?
                 glfw.swap_buffers(self._window)
+                with self._dirty_lock:
+                    self._frame_dirty -= 1
+                t_last_frame = time.perf_counter()
         
         # Update size and pos
         if not self.fullscreen:
             self._width, self._height = glfw.get_framebuffer_size(self._window)
             self.window_pos = glfw.get_window_pos(self._window)
 
+        buf = [
+            '{} {}\n'.format(self._width, self._height),
+            '{} {}\n'.format(*self.window_pos),
+            '{}\n'.format(glfw.get_window_attrib(self._window, glfw.MAXIMIZED)),
+            '{}\n'.format(self.ui_scale),
+            '{}\n'.format(int(self.fullscreen)),
+        ]
+        for k, e in self._editables.items():
+            buf.append(k+'\n')
+            for code in (e.ui_code, e.run_code):
+                buf.append(str(code.count('\n')+1)+'\n')
+                buf.append(code+'\n')
+
         with open(self._inifile, 'w') as file:
-            file.write('{} {}\n'.format(self._width, self._height))
-            file.write('{} {}\n'.format(*self.window_pos))
-            file.write('{}\n'.format(glfw.get_window_attrib(self._window, glfw.MAXIMIZED)))
-            file.write('{}\n'.format(self.ui_scale))
-            file.write('{}\n'.format(int(self.fullscreen)))
-            for k, e in self._editables.items():
-                file.write(k+'\n')
-                for code in (e.ui_code, e.run_code):
-                    lines = code.split('\n')
-                    file.write(str(len(lines))+'\n')
-                    for line in lines:
-                        file.write(line+'\n')
+            file.write(''.join(buf)) # single write
 
         with self.lock():
             self.quit = True
+            self._ui_tid = None
 
         for i in range(len(workers)):
             workers[i].join()
@@ -544,54 +880,139 @@ class viewer:
         glfw.destroy_window(self._window)
         self.pop_context()
     
+    # Upload several images with a single lock, sync and CUDA context push
     @torch.no_grad()
-    def upload_image(self, name, data):
-        if torch.is_tensor(data):
-            if data.device.type in ['mps', 'cpu'] or not self.use_cuda:
-                # would require gl-metal interop or metal UI backend
-                return self.upload_image_np(name, data.cpu().numpy())
+    def upload_batch(self, images, value_range=None, skip_unchanged=False, wait=True):
+        items = [self._upload_item(name, data, value_range) for name, data in images.items()]
+        if skip_unchanged:
+            items = [item for item in items if not self._is_unchanged(*item)]
+        self._submit(items, sync=any(method == 'upload_torch' for _, method, _ in items), wait=wait)
+
+    # value_range: None (detect), '0-1' or '0-255'
+    # Providing it for float CUDA tensors skips a per-frame max() reduction
+    # wait=False: from worker threads, returns before the upload happens (see wait_for_upload)
+    def upload_image(self, name, data, value_range=None, skip_unchanged=False, wait=True):
+        self.upload_batch({name: data}, value_range, skip_unchanged, wait)
+
+    # (name, texture method, args)
+    def _upload_item(self, name, data, value_range):
+        cls = type(data)
+        make_item = self._upload_dispatch.get((cls, data.device.type if cls is torch.Tensor else None))
+        if make_item is None:
+            # Tensor subclasses, other devices
+            if torch.is_tensor(data):
+                make_item = self._upload_dispatch.get((torch.Tensor, data.device.type),
+                    self._torch_item if self.use_cuda else self._tensor_np_item)
             else:
-                return self.upload_image_torch(name, data)
-        else:
-            return self.upload_image_np(name, data)
-
-    # Upload image from PyTorch tensor
-    @torch.no_grad()
-    def upload_image_torch(self, name, tensor):
-        assert isinstance(tensor, torch.Tensor)
+                make_item = self._np_item
+        return make_item(name, data, value_range)
+
+    # Validated here: failures raise in the calling thread, not in the UI loop
+    def _torch_item(self, name, tensor, value_range):
+        assert tensor.device.type == "cuda", "Please provide a CUDA tensor"
+        assert tensor.ndim == 3, "Please provide a HWC tensor"
+        assert tensor.shape[2] < min(tensor.shape[0], tensor.shape[1]), "Please provide a HWC tensor"
+        assert value_range in [None, '0-1', '0-255'], "value_range must be None, '0-1' or '0-255'"
+        return (name, 'upload_torch', (tensor, value_range))
+
+    # skip_unchanged: tensor already in texture and not modified in-place since => skip sync and copy
+    def _is_unchanged(self, name, method, args):
+        tex = self._images.get(name)
+        return method == 'upload_torch' and tex is not None and tex.is_current(*args)
+
+    def _tensor_np_item(self, name, tensor, value_range):
+        return (name, 'upload_np', (tensor.cpu().numpy(),))
+
+    def _np_item(self, name, data, value_range):
+        assert isinstance(data, np.ndarray), f'Unsupported image type {type(data).__name__}'
+        return (name, 'upload_np', (data,))
+
+    def _get_texture(self, name):
+        if name not in self._images:
+            self._images[name] = _texture(self.tex_interp_mode, self._staging_pool)
+        return self._images[name]
+
+    # True if called from another thread while the UI loop owns the GL context
+    def _must_queue(self):
+        return self._ui_tid is not None and self._ui_tid != get_ident()
+
+    # Queue items for UI thread, or upload directly
+    # sync: wait for producing CUDA work before copying
+    # wait: return only once queued uploads are done, data may then be modified.
+    #   With wait=False, upload happens on a later frame: caller must not modify
+    #   the data until wait_for_upload(name) returns
+    def _submit(self, items, sync=False, wait=True):
+        if not items:
+            return
+        if self._must_queue():
+            event = None
+            if sync:
+                event = torch.cuda.Event()
+                event.record() # UI thread waits for this instead of full device sync
+            with self._pending_lock:
+                for name, method, args in items:
+                    self._pending_uploads[name] = (method, args, event)
+            self.request_redraw()
+            if wait:
+                for name, _, _ in items:
+                    while not self.wait_for_upload(name, timeout=0.1) and not self.quit:
+                        pass
+            return
         with self.lock(strict=False) as l:
             if l == nullcontext: # isinstance doesn't work
                 return
-            cuda_synchronize()
+            if sync:
+                cuda_synchronize()
             if not self.quit:
                 self.push_context() # set the context for whichever thread wants to upload
-                if name not in self._images:
-                    self._images[name] = _texture(self.tex_interp_mode)
-                self._images[name].upload_torch(tensor)
+                for name, method, args in items:
+                    getattr(self._get_texture(name), method)(*args)
                 self.pop_context()
+                self.request_redraw()
+
+    # Perform queued uploads, called from UI thread with context current
+    def _process_uploads(self):
+        with self._pending_lock:
+            if not self._pending_uploads:
+                return
+            pending, self._pending_uploads = self._pending_uploads, {}
+            self._processing = pending
+        self.push_context() # once per batch
+        try:
+            for name, (method, args, event) in pending.items():
+                try:
+                    if event is not None:
+                        event.synchronize() # producing kernels done
+                    getattr(self._get_texture(name), method)(*args)
+                except Exception as e: # don't let one bad upload stop the UI loop or its waiters
+                    print(f'Upload of "{name}" failed: {e}')
+        finally:
+            self.pop_context()
+            with self._pending_lock:
+                self._processing = {}
+                self._uploads_done.notify_all()
+
+    # Block until queued upload of 'name' is done, after which its source may be reused
+    # Returns False on timeout
+    def wait_for_upload(self, name, timeout=None):
+        with self._uploads_done:
+            return self._uploads_done.wait_for(
+                lambda: name not in self._pending_uploads and name not in self._processing, timeout)
+
+    # Upload image from PyTorch tensor
+    def upload_image_torch(self, name, tensor, value_range=None, skip_unchanged=False, wait=True):
+        assert isinstance(tensor, torch.Tensor)
+        item = self._torch_item(name, tensor, value_range)
+        if not (skip_unchanged and self._is_unchanged(*item)):
+            self._submit([item], sync=True, wait=wait)
     
     # Upload data from cuda pointer retrieved using custom TF op 
-    def upload_image_TF_ptr(self, name, ptr, shape):
-        with self.lock(strict=False) as l:
-            if l == nullcontext: # isinstance doesn't work
-                return
-            cuda_synchronize()
-            if not self.quit:
-                self.push_context() # set the context for whichever thread wants to upload
-                if name not in self._images:
-                    self._images[name] = _texture(self.tex_interp_mode)
-                self._images[name].upload_ptr(ptr, shape)
-                self.pop_context()
+    def upload_image_TF_ptr(self, name, ptr, shape, wait=True):
+        assert has_pycuda, 'PyCUDA-GL not available, cannot upload using raw pointer'
+        assert shape[2] in [1, 4], 'CUDA-GL interop requires 1 or 4 channels'
+        cuda_synchronize() # TF work is not on torch's stream, event wouldn't cover it
+        self._submit([(name, 'upload_ptr', (ptr, shape))], wait=wait)
 
-    def upload_image_np(self, name, data):
+    def upload_image_np(self, name, data, wait=True):
         assert isinstance(data, np.ndarray)
-        with self.lock(strict=False) as l:
-            if l == nullcontext: # isinstance doesn't work
-                return
-            # cuda_synchronize()
-            if not self.quit:
-                self.push_context() # set the context for whichever thread wants to upload
-                if name not in self._images:
-                    self._images[name] = _texture(self.tex_interp_mode)
-                self._images[name].upload_np(data)
-                self.pop_context()
+        self._submit([self._np_item(name, data, None)], wait=wait)
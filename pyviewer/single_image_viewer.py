@@ -1,6 +1,7 @@
 from pathlib import Path
 from threading import Thread
 import multiprocessing as mp
+from multiprocessing import shared_memory
 import numpy as np
 import random
 import string
@@ -8,21 +9,42 @@ import time
 import glfw
 import imgui
 import ctypes
+import sys
+import queue
+import weakref
 
 has_torch = False
 try:
     import torch
+    import torch.multiprocessing # registers CUDA IPC reductions for mp.Queue
     has_torch = True
 except:
     pass
 
+_is_tensor = torch.is_tensor if has_torch else (lambda x: False)
+
 from .gl_viewer import viewer
 from .utils import begin_inline, normalize_image_data
 
-class ImgShape(ctypes.Structure):
-    _fields_ = [('h', ctypes.c_uint), ('w', ctypes.c_uint), ('c', ctypes.c_uint)]
-class WindowSize(ctypes.Structure):
-    _fields_ = [('w', ctypes.c_uint), ('h', ctypes.c_uint)]
+# Cleanup of shared slots in creating process, on close() or at exit at the latest
+def _release_shared(shms, pinned):
+    for ptr in pinned:
+        torch.cuda.cudart().cudaHostUnregister(ptr)
+    pinned.clear()
+    for shm in shms:
+        try:
+            shm.close()
+        except BufferError:
+            pass # views still alive, mapping released with process
+        shm.unlink()
+
+# Shapes packed into single uint64: read and written in one access, no ctypes struct
+# h: 24 bits, w: 24 bits, c: 16 bits
+def _pack_shape(h, w, c):
+    return (h << 40) | (w << 16) | c
+
+def _unpack_shape(p):
+    return (p >> 40, (p >> 16) & 0xFFFFFF, p & 0xFFFF)
 
 class SingleImageViewer:
     def __init__(self, title, key=None, dtype='uint8', vsync=True, hidden=False, use_cuda=True):
@@ -35,37 +57,90 @@ class SingleImageViewer:
         # Images are copied to minimize critical section time.
         # With uint8 (~4x faster copies than float32), this is
         # faster than waiting for OpenGL upload (for some reason...)
+        # Float input is quantized once in the producer, float16 for HDR data
+        assert dtype in ['uint8', 'float16', 'float32'], "dtype must be 'uint8', 'float16' or 'float32'"
         self.dtype = dtype
 
         # Shared resources for inter-process communication
-        # One shared 8k rgb buffer allocated (max size), subset written to
+        # Shared 8k rgb buffers allocated (max size), subset written to
         # Size does not affect performance, only memory usage
+        # Triple buffered: besides the published and the in-read slot,
+        # one is always free => producer never waits, consumer gets latest frame
         self.max_size = (2*3840, 2*2160, 3)
-        ctype = ctypes.c_uint8 if self.dtype == 'uint8' else ctypes.c_float
-        self.shared_buffer = mp.Array(ctype, np.prod(self.max_size).item())
+        self._max_sz = self.max_size[0] * self.max_size[1] * self.max_size[2] # elements per slot
+        self.n_slots = 3
+        nbytes = np.dtype(self.dtype).itemsize * self._max_sz
+        self.shms = [shared_memory.SharedMemory(create=True, size=nbytes) for _ in range(self.n_slots)] # re-attached by name when pickled
+        self._pinned = {} # slot pointer => registered bytes, prefix used by CUDA frames
+        self._pin_failed = False
+        self._finalizer = weakref.finalize(self, _release_shared, self.shms, self._pinned)
+        self._map_shared()
         
-        # Non-scalar type: not updated in single transaction
-        # Protected by shared_buffer's lock
-        self.latest_shape = mp.Value(ImgShape, *(0,0,0), lock=False)
+        # Slot bookkeeping, protected by slot_lock
+        # Only held for index updates, never during copies
+        self.slot_lock = mp.Lock()
+        self.slot_shapes = mp.RawArray('Q', self.n_slots) # packed (h, w, c)
+        self.latest_slot = mp.RawValue('i', -1) # most recently published
+        self.reading_slot = mp.RawValue('i', -1) # being copied by consumer
         
-        # Current window size, protected by lock
-        self.curr_window_size = mp.Value(WindowSize, *(0,0))
+        # Current window size, packed (w, h)
+        self.curr_window_size = mp.RawValue('Q', 0)
         
         # Scalar values updated atomically
-        self.should_quit = mp.Value('i', 0)
-        self.has_new_img = mp.Value('i', 0)
+        self.should_quit = mp.RawValue('i', 0)
+
+        # Published frame counter, written under slot_lock
+        # Read lock-free by consumer, compared against last seen value
+        self.seq = mp.RawValue('i', 0)
+
+        # Set by producer after each frame, consumer sleeps on it when idle
+        self.frame_ready = mp.Event()
         
         # For hiding/showing window
-        self.hidden = mp.Value(ctypes.c_bool, hidden, lock=False)
+        self.hidden = mp.RawValue(ctypes.c_bool, hidden)
 
         # Pausing (via pause key on keyboard) speeds up computation
-        self.paused = mp.Value(ctypes.c_bool, False, lock=False)
+        self.paused = mp.RawValue(ctypes.c_bool, False)
         
         # For waiting until process has started
-        self.started = mp.Value(ctypes.c_bool, False, lock=False)
+        self.started = mp.RawValue(ctypes.c_bool, False)
+
+        # CUDA tensors are passed as IPC handles, data never leaves the GPU
+        # Not with fork (CUDA unusable in forked children), nor on Windows (no CUDA IPC in PyTorch)
+        # Start method not fixed here: first listed one is the platform default
+        start_method = mp.get_start_method(allow_none=True) or mp.get_all_start_methods()[0]
+        self._cuda_ipc = has_torch and use_cuda and start_method != 'fork' and sys.platform != 'win32' \
+            and torch.cuda.is_available()
+        self.cuda_queue = mp.Queue(maxsize=2) if self._cuda_ipc else None
+        self.cuda_sent = mp.RawValue('Q', 0) # frames put in cuda_queue, consumer counts received ones
+
+        # Shape of latest frame from either path, packed (h, w, c)
+        self.latest_shape = mp.RawValue('Q', 0)
 
         self._start()
 
+        self._xfer_stream = None # device to host copies, created on first CUDA frame
+
+    # Numpy and torch views of shared buffers, created once per process
+    def _map_shared(self):
+        self._slots_np = [np.ndarray((self._max_sz,), dtype=self.dtype, buffer=shm.buf) for shm in self.shms]
+        self._slots_torch = [torch.from_numpy(view) for view in self._slots_np] if has_torch else None
+
+    # Views are process-local, pickling would copy the whole buffers
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_slots_np'] = None
+        state['_slots_torch'] = None
+        state['_xfer_stream'] = None
+        state['_finalizer'] = None # segments are owned by creating process
+        return state
+
+    # Slot that is neither published nor being read, always exists with 3 slots
+    def _acquire_write_slot(self):
+        with self.slot_lock:
+            busy = (self.latest_slot.value, self.reading_slot.value)
+        return next(i for i in range(self.n_slots) if i not in busy)
+
     # Called from main thread, waits until viewer is visible
     def wait_for_startup(self, timeout=15):
         t0 = time.time()
@@ -79,13 +154,12 @@ class SingleImageViewer:
     
     @property
     def curr_shape(self):
-        with self.shared_buffer.get_lock(): # shared lock
-            return (self.latest_shape.h, self.latest_shape.w, self.latest_shape.c)
+        return _unpack_shape(self.latest_shape.value)
 
     @property
     def window_size(self):
-        with self.curr_window_size.get_lock():
-            return (self.curr_window_size.w, self.curr_window_size.h)
+        p = self.curr_window_size.value
+        return (p >> 32, p & 0xFFFFFFFF)
 
     def hide(self):
         self.hidden.value = True
@@ -97,6 +171,7 @@ class SingleImageViewer:
 
     def _start(self):
         self.started.value = False
+        self.cuda_sent.value = 0 # new consumer starts counting from zero
         self.ui_process = mp.Process(target=self.process_func)
         self.ui_process.start()
 
@@ -108,8 +183,11 @@ class SingleImageViewer:
     def close(self):
         self.should_quit.value = 1
         self.ui_process.join()
+        self._slots_np = self._slots_torch = None # views must be gone before closing
+        self._finalizer() # no-op if already called
 
     def process_func(self):
+        self._map_shared()
         # print('process_func, start viewer')
         self.v = viewer(self.title, swap_interval=int(self.vsync), hidden=self.hidden.value, use_cuda=self.use_cuda)
         self.v._window_hidden = self.hidden.value
@@ -128,9 +206,7 @@ class SingleImageViewer:
         self.started.value = False
 
     def window_size_callback(self, window, w, h):
-        with self.curr_window_size.get_lock():
-            self.curr_window_size.w = w
-            self.curr_window_size.h = h
+        self.curr_window_size.value = (w << 32) | h
 
     # Called from main thread
     def draw(self, img_hwc=None, img_chw=None, ignore_pause=False):
@@ -138,38 +214,98 @@ class SingleImageViewer:
         if (self.paused.value and not ignore_pause) or not self.ui_process.is_alive():
             return
 
-        if not has_torch:
-            assert isinstance(img_hwc, (type(None), np.ndarray)), 'PyTorch not available, only numpy arrays supported'
-            assert isinstance(img_chw, (type(None), np.ndarray)), 'PyTorch not available, only numpy arrays supported'
-
-        assert img_hwc is not None or img_chw is not None, 'Must provide img_hwc or img_chw'
-        assert img_hwc is None or img_chw is None, 'Cannot provide both img_hwc and img_chw'
-
-        if has_torch and torch.is_tensor(img_hwc):
-            img_hwc = img_hwc.detach().cpu().numpy()
-
-        if has_torch and torch.is_tensor(img_chw):
-            img_chw = img_chw.detach().cpu().numpy()
+        # Stripped under python -O
+        if __debug__:
+            if not has_torch:
+                assert isinstance(img_hwc, (type(None), np.ndarray)), 'PyTorch not available, only numpy arrays supported'
+                assert isinstance(img_chw, (type(None), np.ndarray)), 'PyTorch not available, only numpy arrays supported'
+
+            assert img_hwc is not None or img_chw is not None, 'Must provide img_hwc or img_chw'
+            assert img_hwc is None or img_chw is None, 'Cannot provide both img_hwc and img_chw'
+
+        img = img_hwc if img_chw is None else img_chw
+        if _is_tensor(img):
+            if img.is_cuda:
+                if self._cuda_ipc:
+                    return self._draw_cuda(img_hwc, img_chw)
+                return self._draw_cuda_host(img_hwc, img_chw)
+            if img_chw is None:
+                img_hwc = img_hwc.detach().cpu().numpy()
+            else:
+                img_chw = img_chw.detach().cpu().numpy()
 
-        # Convert chw to hwc, if provided
+        # Convert chw to hwc, if provided (strided view, no copy)
         if img_chw is not None:
-            img_hwc = np.transpose(img_chw, (1, 2, 0))
+            img_hwc = img_chw.transpose(1, 2, 0)
             img_chw = None        
 
-        sz = np.prod(img_hwc.shape)
-        assert sz <= np.prod(self.max_size), f'Image too large, max size {self.max_size}'
+        H, W = img_hwc.shape[:2]
+        C = 1 if img_hwc.ndim == 2 else min(img_hwc.shape[2], 3)
+        sz = H * W * C
+        assert sz <= self._max_sz, f'Image too large, max size {self.max_size}'
         
-        # Convert data to valid range
-        img_hwc = normalize_image_data(img_hwc)
-
-        # Synchronize
-        with self.shared_buffer.get_lock():
-            arr_np = np.frombuffer(self.shared_buffer.get_obj(), dtype=self.dtype)
-            arr_np[:sz] = img_hwc.reshape(-1)
-            self.latest_shape.h = img_hwc.shape[0]
-            self.latest_shape.w = img_hwc.shape[1]
-            self.latest_shape.c = img_hwc.shape[2]
-            self.has_new_img.value = 1
+        # Convert data to valid range, written straight into
+        # flat prefix of slot viewed as image (any aspect ratio fits)
+        # Single fused pass, strided sources read directly
+        slot = self._acquire_write_slot()
+        normalize_image_data(img_hwc, self.dtype, out=self._slots_np[slot][:sz].reshape(H, W, C))
+        self._publish(slot, (H, W, C))
+
+    def _publish(self, slot, shape_hwc):
+        with self.slot_lock:
+            self.slot_shapes[slot] = _pack_shape(*shape_hwc)
+            self.latest_slot.value = slot
+            self.seq.value += 1
+        self.latest_shape.value = _pack_shape(*shape_hwc)
+        self.frame_ready.set()
+
+    # Normalize on GPU, send IPC handle to UI process
+    def _draw_cuda(self, img_hwc, img_chw):
+        src = img_hwc if img_chw is None else img_chw.permute(1, 2, 0)
+        img = normalize_image_data(src.detach())
+        if img.data_ptr() == src.data_ptr():
+            img = img.clone() # caller may modify its tensor while UI process reads it
+        try:
+            self.cuda_queue.put_nowait(img.contiguous()) # never block caller, consumer only shows newest anyway
+            self.latest_shape.value = _pack_shape(*img.shape)
+            self.cuda_sent.value += 1 # only written by producer thread
+            self.frame_ready.set()
+        except queue.Full:
+            pass # UI process busy, drop frame
+
+    # Normalize on GPU, DMA result straight into shared slot
+    def _draw_cuda_host(self, img_hwc, img_chw):
+        src = img_hwc if img_chw is None else img_chw.permute(1, 2, 0)
+        img = normalize_image_data(src.detach(), self.dtype)
+        assert img.numel() <= self._max_sz, f'Image too large, max size {self.max_size}'
+        slot = self._acquire_write_slot()
+        self._pin_slot(slot, img.numel() * self._slots_np[slot].itemsize)
+        dst = self._slots_torch[slot][:img.numel()].view(img.shape)
+
+        # Copy on side stream: waiting for it doesn't include work queued on the compute stream meanwhile
+        if self._xfer_stream is None or self._xfer_stream.device != img.device:
+            self._xfer_stream = torch.cuda.Stream(img.device)
+        self._xfer_stream.wait_stream(torch.cuda.current_stream(img.device)) # normalization done
+        with torch.cuda.stream(self._xfer_stream):
+            dst.copy_(img, non_blocking=True)
+        self._xfer_stream.synchronize() # copy done before publishing
+        self._publish(slot, img.shape)
+
+    # Page-lock used prefix of shared slot (producer side) for async device to host copies
+    # Only grows: re-registered when a larger frame arrives
+    def _pin_slot(self, slot, nbytes):
+        ptr = self._slots_np[slot].ctypes.data
+        if self._pin_failed or self._pinned.get(ptr, 0) >= nbytes:
+            return
+        cudart = torch.cuda.cudart()
+        if ptr in self._pinned:
+            cudart.cudaHostUnregister(ptr)
+            del self._pinned[ptr]
+        if int(cudart.cudaHostRegister(ptr, nbytes, 0)) == 0:
+            self._pinned[ptr] = nbytes
+        else:
+            self._pin_failed = True
+            print('Could not pin shared memory, copies will be synchronous')
 
     # Called in loop from ui thread
     def ui(self, v):
@@ -206,22 +342,51 @@ class SingleImageViewer:
     # Called in loop from compute thread
     def compute(self, v):
         self.started.value = True
+        last_seq = 0
+        cuda_timeout = 0
+        self._cuda_received = 0
         while not v.quit:
-            if self.has_new_img.value == 1:
-                with self.shared_buffer.get_lock():
-                    shape = self.curr_shape
-                    img = np.frombuffer(self.shared_buffer.get_obj(), dtype=self.dtype, count=np.prod(shape)).copy()
-                    self.has_new_img.value = 0
-
-                img = img.reshape(shape)
-                if img.ndim == 2:
-                    img = np.expand_dims(img, -1)
-                
-                v.upload_image_np(self.key, img)
+            img = self._latest_cuda_frame(cuda_timeout)
+            cuda_timeout = 0
+            if img is not None:
+                v.upload_image_torch(self.key, img)
+            elif self.seq.value != last_seq:
+                with self.slot_lock:
+                    slot = self.latest_slot.value
+                    self.reading_slot.value = slot # producer won't overwrite
+                    h, w, c = _unpack_shape(self.slot_shapes[slot])
+                    last_seq = self.seq.value
+
+                # Uploaded straight from shared slot into texture's PBO,
+                # slot is held until UI thread is done with it (upload waits)
+                v.upload_image_np(self.key, self._slots_np[slot][:h*w*c].reshape(h, w, c))
+                with self.slot_lock:
+                    self.reading_slot.value = -1
             elif self.paused.value:
                 time.sleep(1/10) # paused
             else:
-                time.sleep(1/80) # idle
+                # Idle: block until next frame, state re-checked after clear
+                if self.frame_ready.wait(timeout=0.1):
+                    self.frame_ready.clear()
+                # CUDA frame sent but not received: still in queue's feeder thread, block on queue
+                if self.cuda_sent.value > self._cuda_received:
+                    cuda_timeout = 0.1
+
+    # Newest tensor in CUDA queue, older ones are dropped
+    # timeout: block for first one, returns as soon as it arrives
+    def _latest_cuda_frame(self, timeout=0):
+        img = None
+        if self.cuda_queue is not None:
+            try:
+                if timeout > 0:
+                    img = self.cuda_queue.get(timeout=timeout)
+                    self._cuda_received += 1
+                while True:
+                    img = self.cuda_queue.get_nowait()
+                    self._cuda_received += 1
+            except queue.Empty:
+                pass
+        return img
 
 # Single global instance
 # Removes need to pass variable around in code
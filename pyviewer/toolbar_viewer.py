@@ -77,7 +77,12 @@ class ToolbarViewer:
     def _compute_loop(self):
         while not self.v.quit:
             img = self.compute()
-            if img is not None:
+            if isinstance(img, dict):
+                assert self.output_key in img, 'compute() returned a dict without an entry for output_key'
+                H, W, C = img[self.output_key].shape
+                self.img_shape = [C, H, W]
+                self.v.upload_batch(img)
+            elif img is not None:
                 H, W, C = img.shape
                 self.img_shape = [C, H, W]
                 self.v.upload_image(self.output_key, img)
@@ -213,6 +218,7 @@ class ToolbarViewer:
         pass
     
     # Perform computation, returning single np/torch image, or None
+    # A dict {name: image} uploads all in one batch, output_key is shown
     def compute(self):
         pass
 
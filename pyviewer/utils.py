@@ -7,6 +7,13 @@ from io import BytesIO
 from pathlib import Path
 import os
 
+has_numba = False
+try:
+    from numba import njit, prange
+    has_numba = True
+except ImportError:
+    pass
+
 # with-block for item id
 @contextlib.contextmanager
 def imgui_id(id: str):
@@ -173,9 +180,60 @@ def open_prog(pth, mode):
 
     return fout
 
+if has_numba:
+    # Fused normalize + quantize: reads source once, writes uint8 once
+    @njit(parallel=True, cache=True)
+    def _normalize_u8_kernel(src, dst, lo, scale):
+        for i in prange(dst.shape[0]):
+            for j in range(dst.shape[1]):
+                for c in range(dst.shape[2]):
+                    v = (src[i, j, c] - lo) * scale
+                    dst[i, j, c] = 0 if v < 0 else (255 if v > 255 else np.uint8(v))
+
+# Kernel input types, others (e.g. float16, bool) take the numpy path
+_numba_dtypes = tuple(np.dtype(t) for t in (np.int8, np.int16, np.int32, np.int64,
+    np.uint16, np.uint32, np.uint64, np.float32, np.float64))
+
+# Numpy image to uint8 HWC, at most 3 channels
+def _normalize_np_u8(img_hwc, out=None):
+    if img_hwc.ndim == 2:
+        img_hwc = img_hwc[..., None]
+    img_hwc = img_hwc[:, :, :3]
+
+    # Already valid, no conversion needed
+    if img_hwc.dtype == np.uint8:
+        if out is not None:
+            np.copyto(out, img_hwc)
+            return out
+        return img_hwc if img_hwc.flags.c_contiguous else np.ascontiguousarray(img_hwc)
+
+    # Valid ranges for RGB data
+    is_fp = img_hwc.dtype.kind == 'f'
+    maxval = 1 if is_fp else 255
+    lo, hi = img_hwc.min(), img_hwc.max()
+
+    # If outside of range: normalize to [0, 255]
+    if hi > maxval or lo < 0:
+        scale = 255 / (float(hi) - float(lo)) if hi > lo else 0.0 # as float: no int8/float16 overflow
+    else:
+        lo, scale = 0, 255 / maxval
+
+    if out is None:
+        out = np.empty(img_hwc.shape, dtype=np.uint8)
+    if has_numba and img_hwc.dtype in _numba_dtypes:
+        _normalize_u8_kernel(img_hwc, out, float(lo), float(scale))
+    else:
+        np.copyto(out, np.clip(np.subtract(img_hwc, lo, dtype=np.float32) * scale, 0, 255), casting='unsafe')
+
+    return out
+
 # Convert input image to valid range for showing
-def normalize_image_data(img_hwc, target_dtype='uint8'):    
+# out: optional preallocated destination, result is written into it
+def normalize_image_data(img_hwc, target_dtype='uint8', out=None):
     is_np = isinstance(img_hwc, np.ndarray)
+    if is_np and target_dtype == 'uint8':
+        return _normalize_np_u8(img_hwc, out)
+
     fw = np if is_np else torch
     is_fp = (img_hwc.dtype.kind == 'f') if is_np else img_hwc.dtype.is_floating_point
     
@@ -184,10 +242,11 @@ def normalize_image_data(img_hwc, target_dtype='uint8'):
     minval = 0
     
     # If outside of range: normalize to [0, 1]
-    if img_hwc.max() > maxval or img_hwc.min() < minval:
+    # Out-of-place: .float() / astype may return the caller's array
+    lo, hi = img_hwc.min(), img_hwc.max()
+    if hi > maxval or lo < minval:
         img_hwc = img_hwc.astype(np.float32) if is_np else img_hwc.float()
-        img_hwc -= img_hwc.min() # min is negative
-        img_hwc /= img_hwc.max()
+        img_hwc = (img_hwc - lo) / (hi - lo)
         is_fp = True
         maxval = 1
     
@@ -195,6 +254,12 @@ def normalize_image_data(img_hwc, target_dtype='uint8'):
     if target_dtype == 'uint8':
         img_hwc = img_hwc * 255 if is_fp else img_hwc
         img_hwc = np.uint8(img_hwc) if is_np else img_hwc.byte()
+    elif is_np and out is not None:
+        # Strided source read directly, converted while writing into out
+        if img_hwc.ndim == 2:
+            img_hwc = img_hwc[..., None]
+        np.divide(img_hwc[:, :, :3], maxval, out=out, casting='unsafe')
+        return out
     else:
         img_hwc = img_hwc.astype(fw.float32) if is_np else img_hwc.float()
         img_hwc = img_hwc / maxval
@@ -206,4 +271,8 @@ def normalize_image_data(img_hwc, target_dtype='uint8'):
     # Use at most 3 channels
     img_hwc = img_hwc[:, :, :3]
 
+    if out is not None:
+        out[...] = img_hwc
+        img_hwc = out
+
     return img_hwc
\ No newline at end of file